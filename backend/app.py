@@ -1,11 +1,21 @@
 import os
+import io
+import re
+import csv
 import json
+import time
+import secrets
+import warnings
+import threading
 import unicodedata
 from pathlib import Path
+from contextlib import asynccontextmanager
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import mapclassify
 from shapely.geometry import mapping
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
 from fastapi.responses import FileResponse
@@ -21,6 +31,11 @@ DF_PATH = DATA_DIR / "df_final_f2.csv"
 WORLD_PATH = DATA_DIR / "world_geometries.geojson"
 THAI_DATA_PATH = DATA_DIR / "thailand_subdistrict_cases.csv"
 THAI_GEO_PATH = DATA_DIR / "bangkok_admin3.geojson"
+BKK_BMA_PATH = DATA_DIR / "DHF 2025_01Jul_29Nov by BMA.xls"
+BKK_POP_PATH = (
+    DATA_DIR / "geo_thailand" / "population 2536-2561by subdistrict"
+    / "population 2536-2561by subdistrict" / "stat_t2561.txt"
+)
 CASOS_ARG_PATH = DATA_DIR / "casos_ARG.csv"
 SHP_ARG_PATH = DATA_DIR / "geo_argentina" / "pxdptodatosok.shp"
 # Ruta Brasil (Shapefile absoluto y CSV relativo a data)
@@ -32,7 +47,12 @@ CSV_BRA_PATH = DATA_DIR / "casos_brasil_resumen.csv"
 # ==========================================
 # 2. INICIALIZAR APP
 # ==========================================
-app = FastAPI(title="DengueViewer API")
+@asynccontextmanager
+async def lifespan(app):
+    start_data_watcher()  # Definido en REFRESCO INCREMENTAL
+    yield
+
+app = FastAPI(title="DengueViewer API", lifespan=lifespan)
 
 
 origins = [
@@ -51,19 +71,207 @@ app.add_middleware(
 )
 
 # ==========================================
-# 3. CARGA DE DATOS MUNDIALES (Al inicio)
+# 2.1 CACHÉ DE RESPUESTAS (invalidable por región / semana)
 # ==========================================
-print("--- Cargando Datos Mundiales ---")
-try:
-    df = pd.read_csv(DF_PATH)
-    world = gpd.read_file(WORLD_PATH)
+# Los refrescos de datos (ver sección REFRESCO INCREMENTAL) solo invalidan
+# las llaves afectadas; el resto de respuestas sigue sirviéndose desde aquí.
+response_cache = {}      # (region, key) -> payload listo para devolver
+response_versions = {}   # (region, key) -> versión, sube con cada invalidación
+region_generation = {}   # region -> generación, sube al invalidar la región entera
+response_lock = threading.Lock()  # Versión + guardado / invalidación son atómicos entre sí
+
+def cached_response(region, key, builder):
+    """Devuelve el payload cacheado de (region, key) o lo construye con builder()."""
+    ck = (region, key)
+    hit = response_cache.get(ck)
+    if hit is not None:
+        return hit
+    with response_lock:
+        version = (region_generation.get(region, 0), response_versions.get(ck, 0))
+    payload = builder()  # Fuera del lock: construir puede tardar
+    # Si un refresco invalidó la llave mientras construíamos, no guardamos el dato viejo
+    with response_lock:
+        if version == (region_generation.get(region, 0), response_versions.get(ck, 0)):
+            response_cache[ck] = payload
+    return payload
+
+def invalidate_responses(region, keys=None):
+    """Invalida las llaves indicadas de una región (todas si keys es None)."""
+    with response_lock:
+        if keys is None:
+            region_generation[region] = region_generation.get(region, 0) + 1
+            for ck in [ck for ck in list(response_cache) if ck[0] == region]:
+                response_cache.pop(ck, None)
+            return
+        for key in keys:
+            ck = (region, key)
+            response_versions[ck] = response_versions.get(ck, 0) + 1
+            response_cache.pop(ck, None)
 
-    if "area_km2" not in world.columns:
-        world_aea = world.to_crs("EPSG:6933")
-        world["area_km2"] = world_aea.area / 1_000_000
+# ==========================================
+# 2.2 SEGUIMIENTO DE ARCHIVOS FUENTE (para refrescos incrementales)
+# ==========================================
+source_state = {}  # nombre -> {"path", "offset", "mtime", "tail"}
+TAIL_BYTES = 256   # Bytes previos al offset que usamos para detectar reescrituras
+
+def source_signature(path):
+    """(tamaño, mtime) del archivo. Se toma ANTES de leer: lo que llegue después lo verá el próximo refresco."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+def mark_source_loaded(name, path, offset=None, mtime=None):
+    """Registra hasta qué byte (y con qué mtime) se leyó un archivo fuente."""
+    path = str(path)
+    if not os.path.exists(path):
+        return
+    if offset is None or mtime is None:
+        size, current_mtime = source_signature(path)
+        offset = size if offset is None else offset
+        mtime = current_mtime if mtime is None else mtime
+    start = max(0, offset - TAIL_BYTES)
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        tail = fh.read(offset - start)
+    source_state[name] = {"path": path, "offset": offset, "mtime": mtime, "tail": tail}
+
+def read_source_csv(path, **kwargs):
+    """
+    Lee un CSV completo, pero solo hasta el último salto de línea que existía al empezar
+    (una fila a medio escribir queda para el próximo refresco). Devuelve (DataFrame, firma)
+    donde firma = (offset, mtime) para mark_source_loaded.
+    """
+    size, mtime = source_signature(path)
+    with open(path, "rb") as fh:
+        data = fh.read(size)
+    data = data[:data.rfind(b"\n") + 1]
+    return pd.read_csv(io.BytesIO(data), **kwargs), (len(data), mtime)
+
+def detect_source_change(name):
+    """
+    Compara el archivo con lo último leído:
+    - None: la fuente nunca se cargó (se leerá completa cuando se pida)
+    - 'sin cambios' / 'append' (solo se agregaron filas al final) / 'reload' (se reescribió)
+    """
+    state = source_state.get(name)
+    if state is None or not os.path.exists(state["path"]):
+        return None
+    st = os.stat(state["path"])
+    if st.st_size == state["offset"] and st.st_mtime == state["mtime"]:
+        return "sin cambios"
+    if st.st_size > state["offset"] and state["tail"].endswith(b"\n"):
+        start = state["offset"] - len(state["tail"])
+        with open(state["path"], "rb") as fh:
+            fh.seek(start)
+            if fh.read(len(state["tail"])) == state["tail"]:
+                return "append"
+    return "reload"
+
+def read_appended_csv(name):
+    """
+    Lee solo las filas agregadas desde la última lectura.
+    Corta en el último salto de línea para no parsear una fila a medio escribir.
+    Devuelve (DataFrame, firma) con firma = (nuevo_offset, mtime).
+    """
+    state = source_state[name]
+    size, mtime = source_signature(state["path"])
+    with open(state["path"], "rb") as fh:
+        header = fh.readline().decode("utf-8-sig").strip()
+        fh.seek(state["offset"])
+        chunk = fh.read(size - state["offset"])
+    chunk = chunk[:chunk.rfind(b"\n") + 1]
+    sig = (state["offset"] + len(chunk), mtime)
+
+    try:
+        sep = csv.Sniffer().sniff(header, delimiters=",;\t").delimiter
+    except csv.Error:
+        sep = ","
+    columns = next(csv.reader([header], delimiter=sep))
+
+    if not chunk.strip():
+        return pd.DataFrame(columns=columns), sig
+    rows = pd.read_csv(io.BytesIO(chunk), header=None, names=columns, sep=sep)
+    return rows, sig
+
+# ==========================================
+# 2.3 CLASIFICACIÓN DE COROPLETAS (cortes estables por región)
+# ==========================================
+# Los cortes se calculan una vez con TODAS las semanas de la región, así la
+# leyenda no cambia al mover el slider. Cada feature viaja con su clase entera
+# (class_cases, class_incidence, ...) y el navegador solo la pinta.
+CHOROPLETH_SCHEME = os.environ.get("CHOROPLETH_SCHEME", "fisher_jenks")  # quantiles | fisher_jenks | fixed
+N_CLASSES = 5
+JENKS_SAMPLE = 400  # Fisher-Jenks es cuadrático: se calcula sobre cuantiles (valores observados) de la distribución
+INTEGER_METRICS = {"cases"}  # Conteos: los cortes se publican como enteros
+
+# Umbrales epidemiológicos fijos (borde inferior de cada clase)
+FIXED_EDGES = {
+    "cases": [1, 5, 10, 20, 30, 50, 100],
+    "incidence": [1, 5, 10, 25, 50, 100, 300],  # casos por 100k hab.
+    "density": [0.1, 0.5, 1, 5, 10, 50, 100],   # casos por km²
+}
+
+region_classes = {}  # region -> {métrica: {esquema: bordes inferiores}}
+
+def class_edges(values, metric):
+    """Bordes inferiores de cada clase, por esquema, usando todos los valores > 0 de la serie."""
+    v = np.asarray(values, dtype=float).ravel()
+    v = v[np.isfinite(v) & (v > 0)]
+    edges = {"fixed": FIXED_EDGES[metric]}
+
+    k = min(N_CLASSES, len(np.unique(v)))
+    if k < 2:
+        edges["quantiles"] = edges["fisher_jenks"] = [round(float(v.min()), 4)] if len(v) else []
+        return edges
+
+    u = np.unique(v)
+    # inverted_cdf: la muestra son valores que existen en la serie, no interpolaciones
+    sample = np.quantile(v, np.linspace(0, 1, JENKS_SAMPLE), method="inverted_cdf") if len(v) > JENKS_SAMPLE else v
+    with warnings.catch_warnings():
+        # Con muchos empates Quantiles reduce k por su cuenta (y avisa); sin numba, Jenks avisa que es lento
+        warnings.simplefilter("ignore", category=UserWarning)
+        schemes = (
+            ("quantiles", mapclassify.Quantiles(v, k=k).bins),
+            ("fisher_jenks", mapclassify.FisherJenks(sample, k=k).bins),
+        )
+    for scheme, bins in schemes:
+        # mapclassify devuelve bordes superiores (x <= borde): la clase siguiente arranca en el
+        # primer valor observado mayor, y la clase 1 en el mínimo > 0
+        nxt = u[np.minimum(np.searchsorted(u, bins[:-1], side="right"), len(u) - 1)]
+        lower = np.unique(np.concatenate([[u[0]], nxt]))
+        if metric in INTEGER_METRICS:
+            edges[scheme] = np.unique(np.ceil(lower)).astype(int).tolist()
+        else:
+            edges[scheme] = np.unique(lower.round(4)).tolist()
+    return edges
+
+def classify(values, edges):
+    """Clase entera por valor: 0 = sin casos (bajo el primer borde), k = supera k bordes."""
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    return np.searchsorted(np.asarray(edges, dtype=float), values, side="right").astype(np.int8)
+
+def set_region_classes(region, metrics):
+    """metrics: {métrica: valores de toda la serie}. Devuelve True si los cortes cambiaron."""
+    classes = {metric: class_edges(values, metric) for metric, values in metrics.items()}
+    changed = region_classes.get(region) != classes
+    region_classes[region] = classes
+    return changed
+
+def region_edges(region, metric):
+    """Bordes del esquema activo para una métrica de la región."""
+    return region_classes.get(region, {}).get(metric, {}).get(CHOROPLETH_SCHEME, [])
 
-    world = world[["iso3", "geometry", "area_km2"]]
-    gdf = df.merge(world, on="iso3", how="left")
+# ==========================================
+# 3. CARGA DE DATOS MUNDIALES (Al inicio)
+# ==========================================
+print("--- Cargando Datos Mundiales ---")
+world_geo = None  # Geometrías + área, se reutilizan al refrescar
+
+def build_world_rows(df):
+    """Une filas de df_final con las geometrías y arma la llave year_week."""
+    # df_final ya trae area_km2: manda la del CSV y la de la geometría solo rellena huecos
+    gdf = df.merge(world_geo.rename(columns={"area_km2": "area_geo"}), on="iso3", how="left")
+    gdf["area_km2"] = gdf["area_km2"].fillna(gdf["area_geo"]) if "area_km2" in gdf else gdf["area_geo"]
+    gdf = gdf.drop(columns="area_geo")
     gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs="EPSG:4326")
     gdf = gdf.dropna(subset=["geometry"])
 
@@ -72,6 +280,35 @@ try:
         + "-W"
         + gdf["Epi. Week (a)"].astype(int).astype(str).str.zfill(2)
     )
+    return gdf
+
+def world_metrics(frame):
+    """Casos, incidencia, área y densidad por fila (0 donde falte el dato)."""
+    cases = frame["Casos_Nuevos"].fillna(0).to_numpy(dtype=float)
+    area = frame["area_km2"].fillna(0).to_numpy(dtype=float)
+    return {
+        "cases": cases,
+        "incidence": frame["Inc_Nueva"].fillna(0).to_numpy(dtype=float),
+        "area": area,
+        "density": np.divide(cases, area, out=np.zeros_like(cases), where=area > 0),
+    }
+
+def set_world_classes(frame):
+    metrics = world_metrics(frame)
+    return set_region_classes("world", {m: metrics[m] for m in ("cases", "incidence", "density")})
+
+try:
+    df, world_sig = read_source_csv(DF_PATH)
+    world = gpd.read_file(WORLD_PATH)
+
+    if "area_km2" not in world.columns:
+        world_aea = world.to_crs("EPSG:6933")
+        world["area_km2"] = world_aea.area / 1_000_000
+
+    world_geo = world[["iso3", "geometry", "area_km2"]]
+    gdf = build_world_rows(df)
+    set_world_classes(gdf)
+    mark_source_loaded("world", DF_PATH, *world_sig)
     weeks_list = sorted(gdf["year_week"].unique())
     print(f"Mundo cargado: {len(weeks_list)} semanas.")
 except Exception as e:
@@ -80,38 +317,191 @@ except Exception as e:
     gdf = gpd.GeoDataFrame()
 
 # ==========================================
-# 4. CARGA DE DATOS TAILANDIA
+# 4. MOTOR BANGKOK (SUBDISTRITOS x SEMANAS)
 # ==========================================
-print("--- Cargando Datos Tailandia ---")
+# Una geometría por subdistrito (ID_MAPA) y matrices semana x subdistrito
+# para casos, densidad e incidencia. Los payloads de cada semana se arman
+# una sola vez; el endpoint solo los busca en un dict.
+print("--- Cargando Motor Bangkok ---")
+bkk_engine = None
+col_subdist = 'ADM3_PCODE'
+
+def read_bkk_population():
+    """Población por (distrito, subdistrito) con nombres en tailandés, padrón DOPA 2561 (2018)."""
+    rows, district = [], None
+    with open(BKK_POP_PATH, encoding="cp874") as fh:
+        for line in fh:
+            parts = [p.strip() for p in line.split("|")]
+            name = parts[0]
+            if name.startswith("ท้องถิ่นเขต"):   # Distrito (เขต)
+                district = name[len("ท้องถิ่นเขต"):]
+            elif name.startswith("แขวง"):        # Subdistrito (แขวง), columna 4 = total
+                rows.append((district, name[len("แขวง"):], int(parts[3].replace(",", ""))))
+    return pd.DataFrame(rows, columns=["adm2_name1", "adm3_name1", "population"])
+
+def read_bma_weekly():
+    """Hoja semanal del BMA (fila = subdistrito, columna = semana epi) a formato largo."""
+    raw = pd.read_excel(BKK_BMA_PATH, sheet_name=1, header=None)
+
+    # Año (ej: "Number of DHF cases by Sub-district, BMA, 2025") y fila de encabezados
+    title = " ".join(raw.iloc[:5, 0].dropna().astype(str))
+    year = re.search(r"20\d{2}", title).group(0)
+    hdr = next(i for i in raw.index if (raw.loc[i] == "Sub-district code").any())
+    col_code = raw.columns[(raw.loc[hdr] == "Sub-district code").to_numpy()][0]
+    week_row = raw.loc[hdr + 1]
+    week_cols = [c for c in raw.columns if c != col_code and pd.notna(week_row[c])]
+
+    body = raw.loc[hdr + 2:]
+    body = body[pd.to_numeric(body[col_code], errors="coerce").notna()]
+    long = body.melt(id_vars=[col_code], value_vars=week_cols, var_name="col", value_name="Cases")
+    long["ID_MAPA"] = "TH" + long[col_code].astype(int).astype(str)
+    long["year_week"] = year + "-W" + long["col"].map(week_row).astype(int).astype(str).str.zfill(2)
+    long["Cases"] = pd.to_numeric(long["Cases"], errors="coerce").fillna(0)
+    return long[["ID_MAPA", "year_week", "Cases"]]
+
+def read_bkk_cases():
+    """
+    Casos semanales: hoja del BMA + CSV de subdistritos (el CSV manda si repiten semana).
+    Devuelve (filas, firmas); las firmas se registran recién al publicar el motor.
+    """
+    frames, sigs = [], {}
+    if os.path.exists(BKK_BMA_PATH):
+        sigs[("bangkok_bma", BKK_BMA_PATH)] = source_signature(BKK_BMA_PATH)
+        frames.append(read_bma_weekly())
+    if os.path.exists(THAI_DATA_PATH):
+        rows, sigs[("bangkok", THAI_DATA_PATH)] = read_source_csv(THAI_DATA_PATH)
+        frames.append(rows)
+    return pd.concat(frames, ignore_index=True), sigs
+
+def mark_sources_loaded(sigs):
+    """Registra las firmas devueltas por read_bkk_cases."""
+    for (name, path), sig in sigs.items():
+        mark_source_loaded(name, path, *sig)
+
+def build_bkk_static(gdf_geo, names=None):
+    """Parte fija del motor: ids, nombres, geometrías ya mapeadas, área y población."""
+    gdf_geo = gdf_geo.drop_duplicates(subset=col_subdist).reset_index(drop=True)
+    ids = gdf_geo[col_subdist].astype(str).tolist()
+
+    # Área real en km² (UTM 47N) en lugar de depender de columnas del GeoJSON
+    area = (gdf_geo.to_crs("EPSG:32647").area / 1_000_000).to_numpy()
+
+    # Población: cruce por nombre tailandés de distrito + subdistrito
+    population = np.zeros(len(ids))
+    if os.path.exists(BKK_POP_PATH) and {"adm2_name1", "adm3_name1"} <= set(gdf_geo.columns):
+        pop = read_bkk_population()
+        merged = gdf_geo[["adm2_name1", "adm3_name1"]].merge(pop, on=["adm2_name1", "adm3_name1"], how="left")
+        population = merged["population"].fillna(0).to_numpy(dtype=float)
+        print(f"   Población Bangkok: {int((population > 0).sum())}/{len(ids)} subdistritos con dato.")
+
+    names = names or {}
+    fallback = gdf_geo["adm3_name"] if "adm3_name" in gdf_geo.columns else pd.Series(ids)
+    return {
+        "ids": ids,
+        "index": {id_: j for j, id_ in enumerate(ids)},
+        "names": [names.get(id_, fb) for id_, fb in zip(ids, fallback)],
+        "geometry": [mapping(g) for g in gdf_geo.geometry],
+        "area_km2": area,
+        "population": population,
+    }
+
+def bkk_week_payload(engine, i):
+    """Lista de features de la fila i de las matrices (una por subdistrito)."""
+    st = engine["static"]
+    return [
+        {
+            "district": name,
+            "district_id": id_,
+            "cases": cases,
+            "density": density,
+            "incidence": incidence,
+            "population": int(pop),
+            "class_cases": c_cases,
+            "class_density": c_density,
+            "class_incidence": c_incidence,
+            "geometry": geom,
+        }
+        for name, id_, cases, density, incidence, pop, c_cases, c_density, c_incidence, geom in zip(
+            st["names"], st["ids"],
+            engine["cases"][i].tolist(), engine["density"][i].tolist(),
+            engine["incidence"][i].tolist(), st["population"],
+            engine["classes"]["cases"][i].tolist(), engine["classes"]["density"][i].tolist(),
+            engine["classes"]["incidence"][i].tolist(), st["geometry"],
+        )
+    ]
+
+def bkk_with_rows(engine, rows):
+    """
+    Devuelve un motor nuevo con las filas (ID_MAPA, year_week, Cases) aplicadas.
+    Las semanas nuevas se agregan al índice; solo se rearman los payloads de semanas tocadas.
+    """
+    st = engine["static"]
+    rows = rows.copy()
+    rows["ID_MAPA"] = rows["ID_MAPA"].astype(str)
+    unmatched = rows.loc[~rows["ID_MAPA"].isin(st["index"]), "ID_MAPA"].unique()
+    if len(unmatched):
+        print(f"   ⚠️ {len(unmatched)} subdistritos sin geometría (se ignoran): {sorted(unmatched)[:5]}...")
+    rows = rows[rows["ID_MAPA"].isin(st["index"])].dropna(subset=["year_week"])
+    rows = rows.drop_duplicates(subset=["ID_MAPA", "year_week"], keep="last")
+
+    weeks = sorted(set(engine["weeks"]).union(rows["year_week"]))
+    week_index = {w: i for i, w in enumerate(weeks)}
+
+    cases = np.zeros((len(weeks), len(st["ids"])))
+    cases[[week_index[w] for w in engine["weeks"]]] = engine["cases"]
+    cases[
+        rows["year_week"].map(week_index).to_numpy(),
+        rows["ID_MAPA"].map(st["index"]).to_numpy(),
+    ] = pd.to_numeric(rows["Cases"], errors="coerce").fillna(0).to_numpy(dtype=float)
+
+    area, pop = st["area_km2"], st["population"]
+    density = np.divide(cases, area, out=np.zeros_like(cases), where=area > 0)
+    incidence = np.divide(cases * 100_000, pop, out=np.zeros_like(cases), where=pop > 0).round(2)
+
+    # Cortes con toda la serie; si cambian hay que rearmar todas las semanas
+    metrics = {"cases": cases, "density": density, "incidence": incidence}
+    if set_region_classes("bangkok", metrics):
+        touched = set(weeks)
+    else:
+        touched = set(rows["year_week"])
+
+    new = {
+        "static": st, "weeks": weeks, "week_index": week_index,
+        "cases": cases, "density": density, "incidence": incidence, "payloads": {},
+        "classes": {m: classify(v, region_edges("bangkok", m)) for m, v in metrics.items()},
+    }
+    for w, i in week_index.items():
+        old = engine["payloads"].get(w)
+        new["payloads"][w] = old if old is not None and w not in touched else bkk_week_payload(new, i)
+    return new
+
+def build_bkk_engine(gdf_geo, rows):
+    names = (
+        rows.dropna(subset=["Subdistrict (English)"]).drop_duplicates("ID_MAPA")
+        .set_index("ID_MAPA")["Subdistrict (English)"].to_dict()
+        if "Subdistrict (English)" in rows.columns else {}
+    )
+    static = build_bkk_static(gdf_geo, names)
+    empty = {"static": static, "weeks": [], "cases": np.zeros((0, len(static["ids"]))), "payloads": {}}
+    return bkk_with_rows(empty, rows)
+
 try:
-    df_thai = pd.read_csv(THAI_DATA_PATH)
-    df_thai['ID_MAPA'] = df_thai['ID_MAPA'].astype(str)
-    
     gdf_thai_geo = gpd.read_file(THAI_GEO_PATH)
-    
+
     # Detectar columnas
     col_prov = 'ADM1_PCODE' if 'ADM1_PCODE' in gdf_thai_geo.columns else 'adm1_pcode'
     col_subdist = 'ADM3_PCODE' if 'ADM3_PCODE' in gdf_thai_geo.columns else 'adm3_pcode'
-    
+
     # Filtrar Bangkok (TH10)
     gdf_thai_geo = gdf_thai_geo[gdf_thai_geo[col_prov] == 'TH10'].copy()
-    
-    # Merge
-    gdf_thai = gdf_thai_geo.merge(df_thai, left_on=col_subdist, right_on='ID_MAPA', how='left')
-    gdf_thai['Cases'] = gdf_thai['Cases'].fillna(0)
-    
-    # Densidad
-    if 'area_sqkm' in gdf_thai.columns:
-         gdf_thai['density'] = gdf_thai['Cases'] / gdf_thai['area_sqkm']
-    elif 'Shape_Area' in gdf_thai.columns:
-         gdf_thai['density'] = gdf_thai['Cases'] / (gdf_thai['Shape_Area'] / 1_000_000)
-    else:
-         gdf_thai['density'] = 0
-         
-    print(f"Tailandia OK: {len(gdf_thai)} zonas.")
+
+    bkk_rows, bkk_sigs = read_bkk_cases()
+    bkk_engine = build_bkk_engine(gdf_thai_geo, bkk_rows)
+    mark_sources_loaded(bkk_sigs)
+    print(f"Bangkok OK: {len(bkk_engine['static']['ids'])} subdistritos x {len(bkk_engine['weeks'])} semanas.")
 except Exception as e:
-    print(f"Error Tailandia: {e}")
-    gdf_thai = gpd.GeoDataFrame()
+    print(f"Error Bangkok: {e}")
+    gdf_thai_geo = None
 
 # ==========================================
 # 5. CARGA DE DATOS ARGENTINA (Helpers)
@@ -145,8 +535,49 @@ def clean_text(text):
     text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
     return text
 
+arg_geo_cache = None       # Shapefile con llave key_join
+arg_grouped_cache = None   # Casos agrupados por key_join + semana (se extiende al refrescar)
+
+def prepare_arg_cases(df_casos):
+    """Normaliza columnas del CSV de casos y agrupa por departamento + semana."""
+    df_casos = df_casos.copy()
+    df_casos.columns = df_casos.columns.str.strip().str.upper() # Todo mayúsculas
+
+    # Normalizar columnas
+    if "AÑO" in df_casos.columns: df_casos.rename(columns={"AÑO": "ANIO"}, inplace=True)
+    if "ISO_YEAR" in df_casos.columns: df_casos.rename(columns={"ISO_YEAR": "ANIO"}, inplace=True)
+    if "ISO_WEEK" in df_casos.columns: df_casos.rename(columns={"ISO_WEEK": "SEPI"}, inplace=True)
+
+    # --- PREPARAR LLAVE EN EL CSV ---
+    # Usamos tus columnas: PROVINCIA y DEPARTAMENTO
+    if 'PROVINCIA' not in df_casos.columns or 'DEPARTAMENTO' not in df_casos.columns:
+        raise ValueError("Faltan columnas 'PROVINCIA' o 'DEPARTAMENTO' en el CSV")
+
+    df_casos['key_join'] = (
+        df_casos['PROVINCIA'].apply(clean_text) + "_" + 
+        df_casos['DEPARTAMENTO'].apply(clean_text)
+    )
+
+    df_grouped = df_casos.groupby(["key_join", "ANIO", "SEPI"], as_index=False)["CONFIRMADO"].sum()
+
+    df_grouped["year_week"] = (
+        df_grouped["ANIO"].astype(str) + "-" + 
+        df_grouped["SEPI"].astype(str).str.zfill(2)
+    )
+    return df_grouped
+
+def merge_arg(gdf, df_grouped):
+    """Left merge mapa + casos, dejando solo geometrías con semanas asociadas."""
+    merged = gdf.merge(df_grouped, on="key_join", how="left")
+    merged["CONFIRMADO"] = merged["CONFIRMADO"].fillna(0)
+
+    # Filtramos para devolver solo geometrías con datos temporales asociados
+    # (Ojo: Esto ocultará departamentos que nunca tuvieron casos en el CSV. 
+    #  Si quieres ver el mapa gris de fondo, avísame para cambiar la estrategia)
+    return merged[merged["year_week"].notna()]
+
 def load_arg_data():
-    global gdf_arg_cache
+    global gdf_arg_cache, arg_geo_cache, arg_grouped_cache
     if gdf_arg_cache is not None:
         return gdf_arg_cache
 
@@ -181,44 +612,18 @@ def load_arg_data():
             gdf[col_dept_shp].apply(clean_text)
         )
 
-        # 2. CARGAR CSV
+        # 2. CARGAR CSV + 3. AGRUPAR
         print(f"Leyendo CSV desde: {CASOS_ARG_PATH}")
-        df_casos = pd.read_csv(CASOS_ARG_PATH, sep=None, engine='python')
-        df_casos.columns = df_casos.columns.str.strip().str.upper() # Todo mayúsculas
-
-        # Normalizar columnas
-        if "AÑO" in df_casos.columns: df_casos.rename(columns={"AÑO": "ANIO"}, inplace=True)
-        if "ISO_WEEK" in df_casos.columns: df_casos.rename(columns={"ISO_WEEK": "SEPI"}, inplace=True)
-
-        # --- PREPARAR LLAVE EN EL CSV ---
-        # Usamos tus columnas: PROVINCIA y DEPARTAMENTO
-        if 'PROVINCIA' not in df_casos.columns or 'DEPARTAMENTO' not in df_casos.columns:
-            print("!!! ERROR CSV: Faltan columnas 'PROVINCIA' o 'DEPARTAMENTO'")
-            return pd.DataFrame()
-
-        df_casos['key_join'] = (
-            df_casos['PROVINCIA'].apply(clean_text) + "_" + 
-            df_casos['DEPARTAMENTO'].apply(clean_text)
-        )
-
-        # 3. AGRUPAR
+        df_casos, arg_sig = read_source_csv(CASOS_ARG_PATH, sep=None, engine='python')
         print("Agrupando datos...")
-        df_grouped = df_casos.groupby(["key_join", "ANIO", "SEPI"], as_index=False)["CONFIRMADO"].sum()
-
-        df_grouped["year_week"] = (
-            df_grouped["ANIO"].astype(str) + "-" + 
-            df_grouped["SEPI"].astype(str).str.zfill(2)
-        )
+        df_grouped = prepare_arg_cases(df_casos)
 
         # 4. MERGE (Unir por la llave de texto creada)
-        # Left merge para mantener el mapa completo
-        merged = gdf.merge(df_grouped, on="key_join", how="left")
-        merged["CONFIRMADO"] = merged["CONFIRMADO"].fillna(0)
-        
-        # Filtramos para devolver solo geometrías con datos temporales asociados
-        # (Ojo: Esto ocultará departamentos que nunca tuvieron casos en el CSV. 
-        #  Si quieres ver el mapa gris de fondo, avísame para cambiar la estrategia)
-        gdf_arg_cache = merged[merged["year_week"].notna()]
+        arg_geo_cache = gdf
+        arg_grouped_cache = df_grouped
+        gdf_arg_cache = merge_arg(gdf, df_grouped)
+        set_region_classes("argentina", {"cases": df_grouped["CONFIRMADO"]})
+        mark_source_loaded("argentina", CASOS_ARG_PATH, *arg_sig)
         
         # Diagnóstico
         print(f"Registros finales: {len(gdf_arg_cache)}")
@@ -243,42 +648,63 @@ def get_weeks():
 
 @app.get("/api/cases/{year_week}")
 def get_cases(year_week: str):
-    subset = gdf[gdf["year_week"] == year_week]
-    data = []
-    for _, row in subset.iterrows():
-        cases = float(row.get("Casos_Nuevos", 0) or 0)
-        area = float(row.get("area_km2", 0) or 0)
-        data.append({
-            "country": row["Country"],
-            "cases": cases,
-            "incidence": float(row.get("Inc_Nueva", 0) or 0),
-            "area": area,
-            "density": cases / area if area > 0 else 0.0,
-            "geometry": mapping(row["geometry"]),
-        })
-    return {"week": year_week, "data": data}
+    snapshot = gdf  # Referencia fija: un refresco concurrente no nos cambia los datos a mitad
+    # Solo se cachean semanas existentes: cualquier otro texto no debe crecer la caché
+    if year_week not in weeks_list:
+        return {"error": f"Semana no encontrada: {year_week}"}
+
+    def build():
+        subset = snapshot[snapshot["year_week"] == year_week]
+        metrics = world_metrics(subset)
+        classes = {m: classify(metrics[m], region_edges("world", m)) for m in ("cases", "incidence", "density")}
+        data = []
+        for i, (country, geom) in enumerate(zip(subset["Country"], subset.geometry)):
+            data.append({
+                "country": country,
+                "cases": float(metrics["cases"][i]),
+                "incidence": float(metrics["incidence"][i]),
+                "area": float(metrics["area"][i]),
+                "density": float(metrics["density"][i]),
+                "class_cases": int(classes["cases"][i]),
+                "class_incidence": int(classes["incidence"][i]),
+                "class_density": int(classes["density"][i]),
+                "geometry": mapping(geom),
+            })
+        return {"week": year_week, "data": data}
+
+    return cached_response("world", year_week, build)
 
 # --- TAILANDIA ---
 @app.get("/api/thailand/weeks")
 def get_thai_weeks():
-    if gdf_thai.empty: return []
-    return sorted(gdf_thai["year_week"].dropna().unique().tolist())
+    if bkk_engine is None: return []
+    return bkk_engine["weeks"]
 
 @app.get("/api/thailand/cases/{year_week}")
 def get_thai_cases(year_week: str):
-    if gdf_thai.empty: return {"week": year_week, "data": []}
-    subset = gdf_thai[gdf_thai["year_week"] == year_week]
-    data = []
-    for _, row in subset.iterrows():
-        if pd.isna(row.geometry): continue
-        data.append({
-            "district": row.get("Subdistrict (English)", row.get("adm3_name", "Unknown")),
-            "district_id": str(row.get("ID_MAPA")),
-            "cases": float(row.get("Cases", 0)),
-            "density": float(row.get("density", 0)),
-            "geometry": mapping(row["geometry"])
-        })
-    return {"week": year_week, "data": data}
+    engine = bkk_engine
+    if engine is None: return {"week": year_week, "data": []}
+    return {"week": year_week, "data": engine["payloads"].get(year_week, [])}
+
+# --- LEYENDAS (CORTES DE COROPLETAS) ---
+@app.get("/api/{region}/classes")
+def get_region_classes(region: str):
+    """
+    Cortes de clase precalculados con toda la serie de la región.
+    Cada esquema es una lista de bordes inferiores: clase k = valor >= bordes[k-1].
+    region: world | argentina | brasil | thailand | bangkok. Ojo: "thailand" son los cortes
+    del motor PROVINCIAL mensual (/api/thailand/dates, /api/thailand/data) y "bangkok" los de
+    subdistritos semanales, que son los que usan /api/thailand/weeks y /api/thailand/cases/{year_week}.
+    En Brasil los cortes son de casos semanales: el acumulado (sin week) no trae class_cases.
+    """
+    # Regiones con carga diferida: forzamos la carga para tener los cortes
+    if region == "argentina": load_arg_data()
+    elif region == "brasil": load_brasil_resources()
+    elif region == "thailand": load_thailand_resources()
+
+    if region not in region_classes:
+        return {"error": f"Región sin clasificación: {region}"}
+    return {"scheme": CHOROPLETH_SCHEME, "classes": region_classes[region]}
 
 # --- ARGENTINA ---
 @app.get("/api/argentina/weeks")
@@ -291,8 +717,15 @@ def api_get_arg_weeks():
 def api_get_arg_data(week: str):
     df = load_arg_data()
     if df.empty: return "{}"
-    subset = df[df["year_week"] == week].copy()
-    return json.loads(subset.to_json())
+    if not (df["year_week"] == week).any():
+        return {"error": f"Semana no encontrada: {week}"}
+
+    def build():
+        subset = df[df["year_week"] == week].copy()
+        subset["class_cases"] = classify(subset["CONFIRMADO"], region_edges("argentina", "cases"))
+        return json.loads(subset.to_json())
+
+    return cached_response("argentina", week, build)
 # ==========================================
 # BRASIL (ACTUALIZADO CON FILTRO DE SEMANAS)
 # ==========================================
@@ -300,6 +733,33 @@ def api_get_arg_data(week: str):
 # Variables globales para caché (para no leer el CSV gigante cada vez)
 df_brasil_cache = None
 gdf_brasil_geo_cache = None
+
+def prepare_brasil_cases(df):
+    """Limpia fechas / IDs del CSV de Brasil. Devuelve (filas limpias, agrupado por semana + municipio)."""
+    # Normalizar nombres de columnas (Fecha, ID, Casos)
+    # Tomamos las 3 primeras sin importar cómo se llamen
+    df = df.iloc[:, 0:3].copy()
+    df.columns = ['fecha_raw', 'id_mun', 'casos']
+    
+    # --- CORRECCIÓN FECHAS ---
+    # Convertimos a fecha
+    df['dt'] = pd.to_datetime(df['fecha_raw'], dayfirst=True, errors='coerce')
+    
+    # ELIMINAR FECHAS BASURA (1911, 2106, NaT)
+    # Solo aceptamos datos desde el año 2000 al 2030
+    df = df.dropna(subset=['dt'])
+    df = df[df['dt'].dt.year.between(2000, 2030)]
+    
+    df['year_week'] = df['dt'].dt.strftime('%G-W%V')
+    
+    # --- CORRECCIÓN IDs CSV ---
+    # Convertir a string, quitar decimales (.0), quitar espacios, cortar a 6 chars
+    df['ID_MN_RESI'] = df['id_mun'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip().str.slice(0, 6)
+    
+    # Agrupar (Sumar casos si hay duplicados)
+    df_grouped = df.groupby(['year_week', 'ID_MN_RESI'])['casos'].sum().reset_index()
+    return df, df_grouped
+
 def load_brasil_resources():
     global df_brasil_cache, gdf_brasil_geo_cache
     
@@ -338,32 +798,12 @@ def load_brasil_resources():
             
             try:
                 # Detectar separador automáticamente
-                df = pd.read_csv(CSV_BRA_PATH, sep=None, engine='python')
-                
-                # Normalizar nombres de columnas (Fecha, ID, Casos)
-                # Tomamos las 3 primeras sin importar cómo se llamen
-                df = df.iloc[:, 0:3]
-                df.columns = ['fecha_raw', 'id_mun', 'casos']
-                
-                # --- CORRECCIÓN FECHAS ---
-                # Convertimos a fecha
-                df['dt'] = pd.to_datetime(df['fecha_raw'], dayfirst=True, errors='coerce')
-                
-                # ELIMINAR FECHAS BASURA (1911, 2106, NaT)
-                # Solo aceptamos datos desde el año 2000 al 2030
-                df = df.dropna(subset=['dt'])
-                df = df[df['dt'].dt.year.between(2000, 2030)]
-                
-                df['year_week'] = df['dt'].dt.strftime('%G-W%V')
-                
-                # --- CORRECCIÓN IDs CSV ---
-                # Convertir a string, quitar decimales (.0), quitar espacios, cortar a 6 chars
-                df['ID_MN_RESI'] = df['id_mun'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip().str.slice(0, 6)
-                
-                # Agrupar (Sumar casos si hay duplicados)
-                df_grouped = df.groupby(['year_week', 'ID_MN_RESI'])['casos'].sum().reset_index()
+                df, bra_sig = read_source_csv(CSV_BRA_PATH, sep=None, engine='python')
+                df, df_grouped = prepare_brasil_cases(df)
                 
                 df_brasil_cache = df_grouped
+                set_region_classes("brasil", {"cases": df_grouped["casos"]})
+                mark_source_loaded("brasil", CSV_BRA_PATH, *bra_sig)
                 
                 # --- DIAGNÓSTICO DE CRUCE (LO MÁS IMPORTANTE) ---
                 if gdf_brasil_geo_cache is not None:
@@ -407,37 +847,49 @@ async def get_brasil_data(week: str = None):
         
         if gdf_brasil_geo_cache is None:
             return {"error": "Shapefile no cargado"}
-        
-        gdf = gdf_brasil_geo_cache.copy()
+        geo, cases = gdf_brasil_geo_cache, df_brasil_cache
+        if week and (cases is None or not (cases['year_week'] == week).any()):
+            return {"error": f"Semana no encontrada: {week}"}
 
-        # Filtrar datos
-        if df_brasil_cache is not None:
-            df_filtered = df_brasil_cache
-            
+        def build():
+            gdf = geo.copy()
+
+            # Filtrar datos
+            if cases is not None:
+                df_filtered = cases
+                
+                if week:
+                    print(f">>> [Brasil] Filtrando semana: {week}")
+                    df_filtered = cases[cases['year_week'] == week]
+                
+                # Si hay múltiples filas por municipio en esa semana (raro), sumamos
+                df_grouped = df_filtered.groupby('ID_MN_RESI')['casos'].sum().reset_index()
+                
+                # Merge
+                gdf = gdf.merge(df_grouped, left_on='id_join', right_on='ID_MN_RESI', how='left')
+                gdf["casos"] = gdf["casos"].fillna(0)
+            else:
+                gdf["casos"] = 0
+
+            # Limpieza
+            gdf = gdf.dropna(subset=['geometry'])
+            gdf['NM_MUN'] = gdf['NM_MUN'].fillna("Sin Nombre")
+            columns = ['NM_MUN', 'id_join', 'casos', 'geometry']
             if week:
-                print(f">>> [Brasil] Filtrando semana: {week}")
-                df_filtered = df_brasil_cache[df_brasil_cache['year_week'] == week]
+                # Los cortes son de casos SEMANALES: no sirven para el acumulado total
+                gdf['class_cases'] = classify(gdf['casos'], region_edges("brasil", "cases"))
+                columns.insert(3, 'class_cases')
             
-            # Si hay múltiples filas por municipio en esa semana (raro), sumamos
-            df_grouped = df_filtered.groupby('ID_MN_RESI')['casos'].sum().reset_index()
+            gdf_clean = gdf[columns]
+            gdf_clean = gpd.GeoDataFrame(gdf_clean, geometry='geometry')
             
-            # Merge
-            gdf = gdf.merge(df_grouped, left_on='id_join', right_on='ID_MN_RESI', how='left')
-            gdf["casos"] = gdf["casos"].fillna(0)
-        else:
-            gdf["casos"] = 0
+            # MODO PRUEBA: Si sigue muy lento, descomenta esto:
+            # gdf_clean = gdf_clean.iloc[:200]
 
-        # Limpieza
-        gdf = gdf.dropna(subset=['geometry'])
-        gdf['NM_MUN'] = gdf['NM_MUN'].fillna("Sin Nombre")
-        
-        gdf_clean = gdf[['NM_MUN', 'id_join', 'casos', 'geometry']]
-        gdf_clean = gpd.GeoDataFrame(gdf_clean, geometry='geometry')
-        
-        # MODO PRUEBA: Si sigue muy lento, descomenta esto:
-        # gdf_clean = gdf_clean.iloc[:200]
+            return json.loads(gdf_clean.to_json(na='null', show_bbox=False))
 
-        return json.loads(gdf_clean.to_json(na='null', show_bbox=False))
+        # Sin semana = acumulado total, se invalida con cualquier refresco
+        return cached_response("brasil", week or "total", build)
 
     except Exception as e:
         import traceback
@@ -447,12 +899,6 @@ async def get_brasil_data(week: str = None):
 # TAILANDIA DATA LOADER (CASOS + POBLACIÓN + MAPA)
 # ============================================================
 
-import pandas as pd
-import geopandas as gpd
-import json
-import os
-from pathlib import Path
-
 # --- RUTAS DE ARCHIVOS ---
 # Ajusta los nombres si tus archivos se llaman diferente
 THAI_SHP_PATH = DATA_DIR / "geo_thailand" / "province_dd.shp"
@@ -460,130 +906,193 @@ THAI_CASES_PATH = DATA_DIR / "DengueThailand_2003-2024_Monthly.xlsx"
 THAI_POP_PATH = DATA_DIR / "population_thai.xlsx" # Asegúrate de que este sea el nombre correcto
 
 # Variables globales para caché
-gdf_thai_cache = None       # Guardará Mapa + Población
-df_thai_data_cache = None   # Guardará Casos históricos
+thai_map_cache = None   # Polígonos del mapa con su código de provincia
+thai_engine = None      # Matrices fecha x provincia (casos, incidencia) + población
+
+# Alias de nombres ya normalizados con province_key -> nombre canónico.
+# El resto de diferencias (espacios, mayúsculas, "CHAI NAT" vs "CHAINAT") las absorbe la llave.
+THAI_PROVINCE_ALIASES = {
+    'AYUTTHAYA': 'PHRANAKHONSIAYUTTHAYA',
+    'BANGKOK': 'KRUNGTHEPMAHANAKHONBANGKOK',
+    'BUNGKAN': 'BUENGKAN',
+}
+
+def province_key(name):
+    """Llave de cruce de provincias: solo letras A-Z en mayúsculas, con alias aplicados."""
+    key = re.sub(r"[^A-Z]", "", clean_text(name))
+    return THAI_PROVINCE_ALIASES.get(key, key)
+
+def resolve_province_codes(names, index):
+    """Traduce nombres a códigos enteros (-1 si no existe). Devuelve (códigos, no encontrados)."""
+    codes = np.array([index.get(province_key(n), -1) for n in names], dtype=int)
+    unmatched = sorted(str(n).strip() for n, c in zip(names, codes) if c < 0)
+    return codes, unmatched
+
+def match_thai_map(names, engine):
+    """
+    Cruza los nombres del mapa con el motor en ambas direcciones:
+    provincias del mapa sin casos y columnas de casos que no tienen polígono.
+    """
+    codes, sin_casos = resolve_province_codes(names, engine["index"])
+    dibujadas = set(codes[codes >= 0].tolist())
+    faltan = [k for k in range(len(engine["names"])) if k not in dibujadas]
+    casos_sin_mapa = [engine["names"][k] for k in faltan]
+    if sin_casos:
+        print(f"   ⚠️ {len(sin_casos)} provincias del mapa sin columna de casos: {sin_casos}")
+    if casos_sin_mapa:
+        totales = {engine["names"][k]: int(engine["cases"][:, k].sum()) for k in faltan}
+        print(f"   ⚠️ {len(casos_sin_mapa)} provincias con casos sin polígono en el mapa (casos totales): {totales}")
+    return {"codes": codes, "sin_casos": sin_casos, "casos_sin_mapa": casos_sin_mapa}
 
 def load_thailand_resources():
-    global gdf_thai_cache, df_thai_data_cache
+    global thai_map_cache, thai_engine
     
     # ---------------------------------------------------------
-    # 1. CARGAR MAPA Y POBLACIÓN (SE UNEN UNA SOLA VEZ)
+    # 1. CARGAR CASOS (EXCEL) -> MATRIZ FECHA x PROVINCIA
+    # ---------------------------------------------------------
+    if thai_engine is None:
+        if os.path.exists(THAI_CASES_PATH):
+            print(">>> [Tailandia] Procesando Casos + Población...")
+            try:
+                thai_engine = build_thai_engine()
+                mark_source_loaded("thailand", THAI_CASES_PATH, *thai_engine["source_sig"])
+                print(f"   ✅ Casos cargados: {len(thai_engine['dates'])} fechas x {len(thai_engine['names'])} provincias.")
+            except Exception as e:
+                print(f"❌ Error procesando Casos: {e}")
+                import traceback
+                traceback.print_exc()
+                return
+        else:
+            print(f"❌ No existe Excel de casos en: {THAI_CASES_PATH}")
+            return
+
     # ---------------------------------------------------------
-    if gdf_thai_cache is None:
-        print(">>> [Tailandia] Inicializando Mapa y Población...")
+    # 2. CARGAR MAPA (SE RESUELVE A CÓDIGOS UNA SOLA VEZ)
+    # ---------------------------------------------------------
+    if thai_map_cache is None:
+        print(">>> [Tailandia] Inicializando Mapa...")
         
-        # A) Cargar Shapefile
         if os.path.exists(THAI_SHP_PATH):
             try:
                 gdf = gpd.read_file(THAI_SHP_PATH)
                 if gdf.crs and gdf.crs.to_string() != "EPSG:4326":
                     gdf = gdf.to_crs("EPSG:4326")
                 gdf["geometry"] = gdf["geometry"].simplify(0.01)
+                gdf = gdf.dropna(subset=["geometry"])
                 
                 # Detectar columna de nombre en el mapa (PROV_NAME es lo común)
                 col_mapa = 'PROV_NAME' if 'PROV_NAME' in gdf.columns else gdf.columns[1]
-                gdf['name_join'] = gdf[col_mapa].astype(str).str.strip().str.upper()
+                names = gdf[col_mapa].astype(str).str.strip().tolist()
                 
-                # B) Cargar Población
-                if os.path.exists(THAI_POP_PATH):
-                    print("   + Cruzando datos de población...")
-                    # Leemos Excel o CSV según corresponda
-                    if str(THAI_POP_PATH).endswith('.csv'):
-                        df_pop = pd.read_csv(THAI_POP_PATH)
-                    else:
-                        df_pop = pd.read_excel(THAI_POP_PATH)
-
-                    # Columna de nombre en población ('Name ' con espacio a veces)
-                    col_pop = 'Name ' if 'Name ' in df_pop.columns else 'Name'
-                    df_pop['name_join'] = df_pop[col_pop].astype(str).str.strip().str.upper()
-                    
-                    # CORRECCIONES POBLACIÓN -> MAPA
-                    correcciones_pop = {
-                        'BANGKOK': 'KRUNG THEP MAHA NAKHON (BANGKOK)',
-                        'CHAI NAT': 'CHAINAT',
-                        'BUENG KAN': 'NONG KHAI' # Fallback si el mapa es viejo
-                    }
-                    df_pop['name_join'] = df_pop['name_join'].replace(correcciones_pop)
-                    
-                    # Merge: Mapa + Población
-                    gdf = gdf.merge(df_pop[['name_join', 'Population']], on='name_join', how='left')
-                    gdf['Population'] = gdf['Population'].fillna(0) # Evitar NaNs
-                    
-                    # Diagnóstico
-                    sin_pop = gdf[gdf['Population'] == 0]
-                    if len(sin_pop) > 0:
-                        print(f"   ⚠️ {len(sin_pop)} provincias sin población (se verán pero incidencia será 0).")
-                else:
-                    print("   ❌ No se encontró archivo de población. La incidencia será 0.")
-                    gdf['Population'] = 0
-
-                gdf_thai_cache = gdf
-                print("   ✅ Mapa y Población listos.")
+                thai_map_cache = {
+                    "names": names,
+                    "geometry": [mapping(g) for g in gdf.geometry],
+                    **match_thai_map(names, thai_engine),
+                }
+                print("   ✅ Mapa listo.")
 
             except Exception as e:
-                print(f"❌ Error cargando Mapa/Pob: {e}")
-                return
+                print(f"❌ Error cargando Mapa: {e}")
         else:
             print(f"❌ No existe SHP en: {THAI_SHP_PATH}")
-            return
 
-    # ---------------------------------------------------------
-    # 2. CARGAR CASOS (EXCEL)
-    # ---------------------------------------------------------
-    if df_thai_data_cache is None:
-        if os.path.exists(THAI_CASES_PATH):
-            print(">>> [Tailandia] Procesando Casos...")
-            try:
-                # Leer Excel (o CSV)
-                if str(THAI_CASES_PATH).endswith('.csv'):
-                    df = pd.read_csv(THAI_CASES_PATH)
-                else:
-                    df = pd.read_excel(THAI_CASES_PATH, engine='openpyxl')
-                
-                # Transformar de Ancho a Largo (Melt)
-                df_melted = df.melt(id_vars=['Date'], var_name='province_raw', value_name='cases')
-                
-                # Limpieza Fechas y Casos
-                df_melted['Date'] = pd.to_datetime(df_melted['Date'], errors='coerce')
-                df_melted = df_melted.dropna(subset=['Date'])
-                df_melted['date_str'] = df_melted['Date'].dt.strftime('%Y-%m-%d')
-                df_melted['cases'] = pd.to_numeric(df_melted['cases'], errors='coerce').fillna(0)
-                
-                # Normalizar nombres
-                df_melted['name_join'] = df_melted['province_raw'].astype(str).str.strip().str.upper()
-                
-                # CORRECCIONES CASOS -> MAPA (El Diccionario Definitivo)
-                correcciones_cases = {
-                    'AYUTTHAYA': 'PHRA NAKHON SI AYUTTHAYA',
-                    'BANGKOK': 'KRUNG THEP MAHA NAKHON (BANGKOK)',
-                    'CHAI NAT': 'CHAINAT',
-                    'BUNGKAN': 'BUENG KAN', # O 'NONG KHAI' si el mapa es viejo
-                    'BURI RAM': 'BURIRAM',
-                    'CHON BURI': 'CHONBURI',
-                    'LOP BURI': 'LOPBURI',
-                    'NONG BUA LAM PHU': 'NONG BUA LAMPHU',
-                    'PHANGNGA': 'PHANG NGA',
-                    'PRACHIN BURI': 'PRACHINBURI',
-                    'SI SA KET': 'SISAKET'
-                }
-                df_melted['name_join'] = df_melted['name_join'].replace(correcciones_cases)
-                
-                # Agrupar por si las correcciones generaron duplicados (ej: 2 zonas mapeadas a 1)
-                df_thai_data_cache = df_melted.groupby(['date_str', 'name_join', 'province_raw'], as_index=False)['cases'].sum()
-                print(f"   ✅ Casos cargados: {len(df_thai_data_cache)} registros.")
+def read_thai_cases():
+    """Lee el Excel mensual de casos (ancho: una columna por provincia). Devuelve (wide, firma)."""
+    sig = source_signature(THAI_CASES_PATH)
+    # Leer Excel (o CSV)
+    if str(THAI_CASES_PATH).endswith('.csv'):
+        df = pd.read_csv(THAI_CASES_PATH)
+    else:
+        df = pd.read_excel(THAI_CASES_PATH, engine='openpyxl')
+    
+    # Limpieza Fechas y Casos
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    df = df.dropna(subset=['Date']).sort_values('Date')
+    wide = df.drop(columns=['Date']).apply(pd.to_numeric, errors='coerce').fillna(0)
+    wide.index = df['Date'].dt.strftime('%Y-%m-%d')
+    return wide, sig
+
+def read_thai_population():
+    """Población por provincia (nombre crudo -> habitantes)."""
+    if not os.path.exists(THAI_POP_PATH):
+        print("   ❌ No se encontró archivo de población. La incidencia será 0.")
+        return pd.Series(dtype=float)
+    # Leemos Excel o CSV según corresponda
+    if str(THAI_POP_PATH).endswith('.csv'):
+        df_pop = pd.read_csv(THAI_POP_PATH)
+    else:
+        df_pop = pd.read_excel(THAI_POP_PATH)
+    # Columna de nombre en población ('Name ' con espacio a veces)
+    col_pop = 'Name ' if 'Name ' in df_pop.columns else 'Name'
+    return pd.Series(df_pop['Population'].to_numpy(dtype=float), index=df_pop[col_pop].astype(str).str.strip())
 
-            except Exception as e:
-                print(f"❌ Error procesando Casos: {e}")
-                import traceback
-                traceback.print_exc()
+def build_thai_engine():
+    """
+    Resuelve provincias a códigos enteros y arma:
+    - cases: matriz fecha x provincia
+    - population: vector por provincia
+    - incidence: cases / population * 100k, calculada para todas las fechas de una vez
+    """
+    wide, sig = read_thai_cases()
+
+    # Universo de provincias = columnas del Excel, agrupando las que caen en la misma llave
+    keys = [province_key(c) for c in wide.columns]
+    index = {}
+    for key in keys:
+        index.setdefault(key, len(index))
+    names = [None] * len(index)
+    for col, key in zip(wide.columns, keys):
+        names[index[key]] = names[index[key]] or str(col).strip()
+
+    cases = np.zeros((len(wide), len(index)))
+    np.add.at(cases, (slice(None), [index[k] for k in keys]), wide.to_numpy(dtype=float))
+
+    # Población -> vector alineado a los códigos
+    pop = read_thai_population()
+    pop_codes, sin_provincia = resolve_province_codes(pop.index, index)
+    population = np.zeros(len(index))
+    np.add.at(population, pop_codes[pop_codes >= 0], pop.to_numpy()[pop_codes >= 0])
+    sin_poblacion = [names[c] for c in range(len(index)) if population[c] == 0]
+    if sin_provincia or sin_poblacion:
+        print(f"   ⚠️ Población sin provincia: {sin_provincia} | Provincias sin población: {sin_poblacion}")
+
+    # Solo dividimos donde Población > 0 (si no, incidencia 0)
+    incidence = np.divide(cases * 100_000, population, out=np.zeros_like(cases), where=population > 0).round(2)
+
+    metrics = {"cases": cases, "incidence": incidence}
+    set_region_classes("thailand", metrics)
+
+    dates = wide.index.tolist()
+    return {
+        "dates": dates,
+        "date_index": {d: i for i, d in enumerate(dates)},
+        "names": names,
+        "index": index,
+        "cases": cases,
+        "population": population,
+        "incidence": incidence,
+        "classes": {m: classify(v, region_edges("thailand", m)) for m, v in metrics.items()},
+        "source_sig": sig,  # Se registra con mark_source_loaded al publicar el motor
+        "sin_poblacion": sin_poblacion,
+        "poblacion_sin_provincia": sin_provincia,
+    }
+
+def thai_cases_long(engine):
+    """Matriz de casos en formato largo (date_str, province_raw, cases) para el modelo."""
+    n_dates, n_prov = engine["cases"].shape
+    return pd.DataFrame({
+        "date_str": np.repeat(engine["dates"], n_prov),
+        "province_raw": np.tile(engine["names"], n_dates),
+        "cases": engine["cases"].ravel(),
+    })
 
 # --- ENDPOINTS API ---
 
 @app.get("/api/thailand/dates")
 def get_thai_dates():
     load_thailand_resources()
-    if df_thai_data_cache is not None:
-        return sorted(df_thai_data_cache['date_str'].unique().tolist())
+    if thai_engine is not None:
+        return thai_engine["dates"]
     return []
 
 @app.get("/api/thailand/data")
@@ -595,48 +1104,55 @@ def get_thai_data(date: str):
     - Population: Población total
     """
     load_thailand_resources()
+    engine, geo = thai_engine, thai_map_cache
     
-    if gdf_thai_cache is None or df_thai_data_cache is None:
+    if engine is None or geo is None:
         return {"features": []}
-        
-    try:
-        # 1. Filtrar casos por la fecha solicitada
-        df_filtered = df_thai_data_cache[df_thai_data_cache['date_str'] == date]
-        
-        # 2. Merge: (Mapa + Población) LEFT JOIN (Casos)
-        merged = gdf_thai_cache.merge(df_filtered, on='name_join', how='left')
-        
-        # 3. Limpieza de nulos
-        merged['cases'] = merged['cases'].fillna(0)
-        merged['province_display'] = merged['province_raw'].fillna(merged['name_join'])
-        
-        # 4. CÁLCULO DE INCIDENCIA
-        # Fórmula: (Casos / Población) * 100,000
-        merged['incidence'] = 0.0
-        
-        # Solo calculamos donde Población > 0 para evitar división por cero
-        mask = merged['Population'] > 0
-        merged.loc[mask, 'incidence'] = (merged.loc[mask, 'cases'] / merged.loc[mask, 'Population']) * 100000
-        
-        # Redondear a 2 decimales
-        merged['incidence'] = merged['incidence'].round(2)
-        
-        # 5. Generar GeoJSON
-        # Seleccionamos solo las columnas necesarias para enviar menos datos
-        gdf_clean = merged[['province_display', 'cases', 'incidence', 'Population', 'geometry']]
-        
-        return json.loads(gdf_clean.to_json(na='null', show_bbox=False))
-        
-    except Exception as e:
-        print(f"Error en endpoint Tailandia: {e}")
-        return {"error": str(e)}
-    
+
+    # Una fila de las matrices; fechas sin datos devuelven el mapa en 0
+    i = engine["date_index"].get(date)
+    n_prov = len(engine["names"])
+    cases = engine["cases"][i] if i is not None else np.zeros(n_prov)
+    incidence = engine["incidence"][i] if i is not None else np.zeros(n_prov)
+    c_cases = engine["classes"]["cases"][i] if i is not None else np.zeros(n_prov, dtype=np.int8)
+    c_incidence = engine["classes"]["incidence"][i] if i is not None else np.zeros(n_prov, dtype=np.int8)
+
+    features = []
+    for k, (code, name, geom) in enumerate(zip(geo["codes"], geo["names"], geo["geometry"])):
+        matched = code >= 0
+        features.append({
+            "id": str(k),
+            "type": "Feature",
+            "properties": {
+                "province_display": engine["names"][code] if matched else name,
+                "cases": float(cases[code]) if matched else 0.0,
+                "incidence": float(incidence[code]) if matched else 0.0,
+                "Population": float(engine["population"][code]) if matched else 0.0,
+                "class_cases": int(c_cases[code]) if matched else 0,
+                "class_incidence": int(c_incidence[code]) if matched else 0,
+            },
+            "geometry": geom,
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+@app.get("/api/thailand/unmatched")
+def get_thai_unmatched():
+    """Reporte de nombres de provincia que no se pudieron cruzar."""
+    load_thailand_resources()
+    if thai_engine is None:
+        return {}
+    return {
+        "mapa_sin_casos": thai_map_cache["sin_casos"] if thai_map_cache else [],
+        "casos_sin_mapa": thai_map_cache["casos_sin_mapa"] if thai_map_cache else [],
+        "poblacion_sin_provincia": thai_engine["poblacion_sin_provincia"],
+        "provincias_sin_poblacion": thai_engine["sin_poblacion"],
+    }
+
 
 #### BORRAR EN CASO DE ERROR
 
 # --- AGREGAR ESTAS LIBRERÍAS AL INICIO ---
 from sklearn.ensemble import HistGradientBoostingRegressor
-from sklearn.metrics import mean_squared_error, mean_absolute_error
 
 # ... (Tus otras importaciones y variables globales) ...
 
@@ -645,86 +1161,56 @@ from sklearn.metrics import mean_squared_error, mean_absolute_error
 # ============================================================
 
 model_cache = None # Guardará {model, df_test, metrics, features}
+from thai_model import THAI_MODEL_PATH, build_thai_features, thai_rmse_metrics  # Compartido con backtest_thai.py
+
+def load_promoted_model(features):
+    """Modelo promovido por el backtesting (None si no hay artefacto o no coincide en features)."""
+    if not os.path.exists(THAI_MODEL_PATH):
+        return None
+    try:
+        artifact = pd.read_pickle(THAI_MODEL_PATH)
+    except Exception as e:
+        print(f"   ⚠️ No se pudo leer {THAI_MODEL_PATH}: {e}")
+        return None
+    if artifact.get("features") != features:
+        print("   ⚠️ El artefacto promovido usa otras features; se entrena el modelo por defecto.")
+        return None
+    return artifact
 
 def get_thai_model_resources():
     global model_cache
     if model_cache is not None:
         return model_cache
 
-    print(">>> [ML Engine] Entrenando modelo de Tailandia...")
+    print(">>> [ML Engine] Preparando modelo de Tailandia...")
     
     # 1. Reutilizamos la función de carga que ya tienes para obtener el DF limpio
-    load_thailand_resources() # Asegura que df_thai_data_cache y clima estén cargados
-    
-    # Nota: Aquí asumimos que load_thailand_resources ya cargó y unió Casos + Clima + Vecinos.
-    # Si tu función load_thailand_resources solo carga el raw, necesitamos replicar
-    # la ingeniería de features (lags, log, etc) aquí. 
-    # POR SIMPLICIDAD: Asumiré que copias el bloque de "Feature Engineering" aquí dentro.
-    
-    # --- REPLICAR INGENIERÍA DE FEATURES DEL NOTEBOOK ---
-    # (Para no hacer el código gigante aquí, asegúrate de que df_thai_data_cache 
-    # tenga las columnas 'change_t-1', 'temp_t-1', etc. Si no, añádelas aquí).
-    
-    # Supongamos que df_thai_data_cache ya tiene los merges básicos.
-    # Recalculamos features rápido para asegurar:
-    df = df_thai_data_cache.copy() # Usar el df global cargado previamente
-    
-    # Asegurar orden
-    df['date'] = pd.to_datetime(df['date_str'])
-    df = df.sort_values(['province_raw', 'date'])
-    
-    # Target y Features
-    df['log_cases'] = np.log1p(df['cases'])
-    df['y_change_t1'] = df.groupby('province_raw')['log_cases'].shift(-1) - df['log_cases']
-    
-    # Lags (Simplificado para producción)
-    for l in [1, 2, 3]:
-        df[f'change_t-{l}'] = df.groupby('province_raw')['log_cases'].shift(l) - df.groupby('province_raw')['log_cases'].shift(l+1)
-        # Asumiendo que ya tienes clima y vecinos unidos en df_thai_data_cache
-        # Si no, deberías hacer los merges aquí igual que en el notebook.
-    
-    df['month'] = df['date'].dt.month
-    df_model = df.dropna().copy()
+    load_thailand_resources() # Asegura que thai_engine esté cargado
+    df_model, features = build_thai_features(thai_cases_long(thai_engine))
     
     # --- ENTRENAMIENTO ---
     train = df_model[df_model['date'].dt.year < 2024]
     test = df_model[df_model['date'].dt.year == 2024]
     
-    features = [c for c in df_model.columns if 'change_t-' in c or c == 'month']
-    # (Añade temp/rain/vecinos a 'features' si están en tu df global)
-    
     target = 'y_change_t1'
     
     X_train, y_train = train[features], train[target]
     X_test, y_test = test[features], test[target]
     
-    weights = 1 + (y_train.abs() * 5)
-    
-    model = HistGradientBoostingRegressor(max_depth=10, random_state=42)
-    model.fit(X_train, y_train, sample_weight=weights)
+    artifact = load_promoted_model(features)
+    if artifact is not None:
+        # Ya entrenado con datos < 2024 por backtest_thai.py
+        model, model_name = artifact["model"], artifact["name"]
+        print(f"   ✅ Usando modelo promovido: {model_name} {artifact['params']}")
+    else:
+        weights = 1 + (y_train.abs() * 5)
+        model = HistGradientBoostingRegressor(max_depth=10, random_state=42)
+        model.fit(X_train, y_train, sample_weight=weights)
+        model_name = "hgb"
     
     # --- CÁLCULO DE MÉTRICAS (Una sola vez) ---
-    pred_model = model.predict(X_test)
-    pred_base = np.zeros_like(pred_model)
-    
-    # Globales
-    rmse_g = np.sqrt(mean_squared_error(y_test, pred_model))
-    rmse_b = np.sqrt(mean_squared_error(y_test, pred_base))
-    
-    # Brotes
-    umbral = y_test.abs().quantile(0.8)
-    mask = y_test.abs() >= umbral
-    rmse_g_out = np.sqrt(mean_squared_error(y_test[mask], pred_model[mask]))
-    rmse_b_out = np.sqrt(mean_squared_error(y_test[mask], pred_base[mask]))
-    
-    metrics = {
-        "global": {"rmse_model": round(rmse_g, 4), "rmse_base": round(rmse_b, 4)},
-        "outbreak": {
-            "rmse_model": round(rmse_g_out, 4), 
-            "rmse_base": round(rmse_b_out, 4),
-            "improvement": round(100 * (1 - rmse_g_out/rmse_b_out), 1)
-        }
-    }
+    metrics = thai_rmse_metrics(y_test, model.predict(X_test))
+    metrics["model"] = model_name
     
     model_cache = {
         "model": model,
@@ -773,4 +1259,387 @@ def get_model_graph(province: str):
         "real": real_vals.fillna(0).tolist(),
         "model": pred_vals.fillna(0).tolist(),
         "baseline": base_vals.fillna(0).tolist()
-    }
\ No newline at end of file
+    }
+
+# ============================================================
+# MOTOR DE ALERTAS (BROTES / ANOMALÍAS) POR REGIÓN
+# ============================================================
+# Para cada región se arma una matriz semana x zona y, en una sola pasada de
+# NumPy, se calcula la línea base (mediana de la misma semana epi en las
+# temporadas anteriores), el z-score robusto y el nivel de alerta de TODAS
+# las semanas. Los payloads quedan listos en alerts_cache.
+#
+# El dengue está muy sobredisperso (un año epidémico triplica fácilmente la
+# mediana), así que el z se mide sobre log1p(casos): la dispersión queda
+# proporcional a la línea base, como en una binomial negativa. Con los datos
+# mensuales de Tailandia 2003-2024 esto marca ~8% alerta / ~2% brote de las
+# provincias-mes evaluables, concentrados en los años epidémicos (2013, 2015,
+# 2019); con la escala de Poisson anterior eran 28% / 21%.
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+ALERT_SEASONS = 5        # Temporadas previas usadas como línea base
+ALERT_MIN_SEASONS = 3    # Mínimo de temporadas con dato para evaluar
+ALERT_Z = 2.0            # z >= 2 -> "alerta"
+OUTBREAK_Z = 3.0         # z >= 3 -> "brote"
+ALERT_MIN_CASES = 5      # Ignorar zonas con muy pocos casos
+
+alerts_cache = {}       # region -> resultado de compute_alerts (se invalida al refrescar)
+alerts_generation = {}  # region -> generación, sube con cada refresco que cambia la región
+
+def invalidate_alerts(region):
+    """Descarta las alertas de la región; un cálculo en curso ya no podrá guardarse."""
+    with response_lock:
+        alerts_generation[region] = alerts_generation.get(region, 0) + 1
+        alerts_cache.pop(region, None)
+
+def period_of(label):
+    """'2024-W05' / '2024-05' -> (2024, 5) semana; '2024-05-01' -> (2024, 5) mes."""
+    m = re.match(r"^(\d{4})-W?(\d{1,2})(?:-\d{2})?$", str(label))
+    return (int(m.group(1)), int(m.group(2))) if m else (None, None)
+
+def cube_from_long(df, week_col, region_col, value_col):
+    """Formato largo -> (semanas, zonas, matriz semana x zona). Zona sin fila en una semana = 0."""
+    pivot = df.pivot_table(index=week_col, columns=region_col, values=value_col, aggfunc="sum", fill_value=0)
+    pivot = pivot.sort_index()
+    return pivot.index.astype(str).tolist(), pivot.columns.astype(str).tolist(), pivot.to_numpy(dtype=np.float32)
+
+def detect_anomalies(weeks, values):
+    """
+    values: matriz semana x zona. Devuelve matrices del mismo tamaño con
+    baseline (en casos), z-score robusto sobre log1p(casos) y nivel (0 = normal, 1 = alerta, 2 = brote).
+    """
+    periods = [period_of(w) for w in weeks]
+    valid = np.array([y is not None for y, _ in periods])
+    years = np.array([y if y is not None else 0 for y, _ in periods])
+    steps = np.array([p if p is not None else 0 for _, p in periods])
+
+    # Cubo temporada x semana_epi x zona (NaN = semana no observada)
+    y0 = years[valid].min() if valid.any() else 0
+    n_years = (years[valid].max() - y0 + 1) if valid.any() else 0
+    cube = np.full((n_years, 54, values.shape[1]), np.nan, dtype=np.float32)
+    y_idx, p_idx = years[valid] - y0, steps[valid]
+    cube[y_idx, p_idx] = values[valid]
+
+    # Ventana de las ALERT_SEASONS temporadas anteriores para cada temporada
+    pad = np.full((ALERT_SEASONS,) + cube.shape[1:], np.nan, dtype=np.float32)
+    windows = sliding_window_view(np.concatenate([pad, cube]), ALERT_SEASONS, axis=0)
+    history = windows[y_idx, p_idx]   # (semanas válidas, zonas, temporadas)
+
+    n_hist = (~np.isnan(history)).sum(axis=-1)
+    log_hist = np.log1p(np.fmax(history, 0))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # Slices todo-NaN
+        log_base = np.nanmedian(log_hist, axis=-1)
+        dev = np.abs(log_hist - log_base[..., None])
+        mad = np.nanmedian(dev, axis=-1) * 1.4826
+        # Dispersión de la zona: MAD de todas las semanas de la misma temporada
+        # (todas miran las mismas temporadas previas, así que no usa datos futuros)
+        zone_mad = np.full_like(mad, np.nan)
+        for season in np.unique(y_idx):
+            rows = y_idx == season
+            pooled = np.moveaxis(dev[rows], 1, 0).reshape(dev.shape[1], -1)
+            zone_mad[rows] = np.nanmedian(pooled, axis=1) * 1.4826
+    baseline = np.expm1(log_base)
+
+    # Escala: la mayor entre la MAD de la celda, la de la zona y un piso de Poisson
+    # (sd de log1p(X) ~ 1/sqrt(1 + media) para conteos chicos)
+    scale = np.fmax(np.fmax(mad, np.nan_to_num(zone_mad)), 1 / np.sqrt(1 + np.fmax(baseline, 0)))
+    current = values[valid]
+    z = np.where(n_hist >= ALERT_MIN_SEASONS, (np.log1p(np.fmax(current, 0)) - log_base) / scale, np.nan)
+
+    level = np.zeros(z.shape, dtype=np.int8)
+    evaluable = ~np.isnan(z) & (current >= ALERT_MIN_CASES)
+    level[evaluable & (z >= ALERT_Z)] = 1
+    level[evaluable & (z >= OUTBREAK_Z)] = 2
+
+    out = {k: np.full(values.shape, np.nan, dtype=np.float32) for k in ("baseline", "z")}
+    out["baseline"][valid], out["z"][valid] = baseline, z
+    out["level"] = np.zeros(values.shape, dtype=np.int8)
+    out["level"][valid] = level
+    return out
+
+def region_cube(region):
+    """Matriz semana x zona del snapshot actual de cada región: (semanas, ids, nombres, valores)."""
+    if region == "world":
+        if gdf.empty: return None
+        weeks, ids, values = cube_from_long(gdf, "year_week", "Country", "Casos_Nuevos")
+        return weeks, ids, ids, values
+    if region == "argentina":
+        load_arg_data()
+        if arg_grouped_cache is None: return None
+        weeks, ids, values = cube_from_long(arg_grouped_cache, "year_week", "key_join", "CONFIRMADO")
+        return weeks, ids, ids, values
+    if region == "brasil":
+        load_brasil_resources()
+        if df_brasil_cache is None: return None
+        weeks, ids, values = cube_from_long(df_brasil_cache, "year_week", "ID_MN_RESI", "casos")
+        names = ids
+        if gdf_brasil_geo_cache is not None:
+            lookup = gdf_brasil_geo_cache.drop_duplicates("id_join").set_index("id_join")["NM_MUN"]
+            names = [lookup.get(i, i) for i in ids]
+        return weeks, ids, names, values
+    if region == "thailand":
+        load_thailand_resources()
+        engine = thai_engine
+        if engine is None: return None
+        return engine["dates"], engine["names"], engine["names"], engine["cases"].astype(np.float32)
+    if region == "bangkok":
+        engine = bkk_engine
+        if engine is None: return None
+        st = engine["static"]
+        return engine["weeks"], st["ids"], st["names"], engine["cases"].astype(np.float32)
+    return None
+
+def compute_alerts(region):
+    """Calcula (una vez) las alertas de todas las semanas de una región."""
+    cached = alerts_cache.get(region)
+    if cached is not None:
+        return cached
+    with response_lock:
+        generation = alerts_generation.get(region, 0)
+    cube = region_cube(region)
+    if cube is None:
+        return None
+
+    weeks, ids, names, values = cube
+    print(f">>> [Alertas] {region}: {values.shape[0]} semanas x {values.shape[1]} zonas")
+    res = detect_anomalies(weeks, values)
+
+    payloads = {}
+    for t, week in enumerate(weeks):
+        hits = np.flatnonzero(res["level"][t])
+        hits = hits[np.argsort(-res["z"][t, hits])]
+        payloads[week] = {
+            "region": region,
+            "week": week,
+            "summary": {
+                "alerta": int((res["level"][t] == 1).sum()),
+                "brote": int((res["level"][t] == 2).sum()),
+            },
+            "alerts": [
+                {
+                    "id": ids[j],
+                    "name": names[j],
+                    "value": float(values[t, j]),
+                    "baseline": round(float(res["baseline"][t, j]), 2),
+                    "z": round(float(res["z"][t, j]), 2),
+                    "level": "brote" if res["level"][t, j] == 2 else "alerta",
+                }
+                for j in hits
+            ],
+        }
+    result = {"weeks": weeks, "payloads": payloads}
+    # Si hubo un refresco mientras calculábamos, el resultado sirve para este request pero no se guarda
+    with response_lock:
+        if generation == alerts_generation.get(region, 0):
+            alerts_cache[region] = result
+    return result
+
+@app.get("/api/{region}/alerts")
+def get_alerts(region: str, week: str = None):
+    """
+    Zonas con casos por encima de lo esperado para esa semana epi.
+    region: world | argentina | brasil | thailand | bangkok. Sin week -> última semana.
+    Ojo: acá "thailand" es el motor PROVINCIAL mensual (week = fecha 'YYYY-MM-DD' del Excel)
+    y "bangkok" el de subdistritos semanal ('YYYY-Www'), que es el que sirven
+    /api/thailand/weeks y /api/thailand/cases por razones históricas.
+    """
+    result = compute_alerts(region)
+    if result is None:
+        return {"error": f"Región sin datos de alertas: {region}"}
+    if not result["weeks"]:
+        return {"region": region, "week": week, "summary": {"alerta": 0, "brote": 0}, "alerts": []}
+    week = week or result["weeks"][-1]
+    payload = result["payloads"].get(week)
+    if payload is None:
+        return {"error": f"Semana no encontrada: {week}"}
+    return payload
+
+# ============================================================
+# REFRESCO INCREMENTAL DE DATOS (sin reiniciar el servicio)
+# ============================================================
+# Cada fuente recuerda hasta qué byte se leyó (ver source_state). Si el archivo
+# solo creció, se parsean únicamente las filas nuevas; si se reescribió, se
+# recarga entero. El snapshot nuevo se arma aparte y se publica reasignando la
+# variable global, así los requests en curso terminan con la referencia vieja.
+
+REFRESH_INTERVAL = int(os.environ.get("DATA_REFRESH_SECONDS", "300"))  # 0 = sin vigilancia
+refresh_lock = threading.Lock()  # Serializa refrescos (los requests nunca lo toman)
+
+def replace_rows(old, new, keys):
+    """Concatena new sobre old, descartando de old las filas con las mismas llaves."""
+    old_key = pd.MultiIndex.from_frame(old[keys].astype(str))
+    new_key = pd.MultiIndex.from_frame(new[keys].astype(str))
+    merged = pd.concat([old[~old_key.isin(new_key)], new], ignore_index=True)
+    return gpd.GeoDataFrame(merged, geometry="geometry", crs=old.crs)
+
+def refresh_world():
+    global gdf, weeks_list
+    change = detect_source_change("world")
+    if change in (None, "sin cambios") or world_geo is None:
+        return None
+
+    if change == "append":
+        rows, sig = read_appended_csv("world")
+        new_rows = build_world_rows(rows)
+        affected = sorted(new_rows["year_week"].unique())
+        snapshot = replace_rows(gdf, new_rows, ["iso3", "year_week"])
+        weeks = sorted(set(weeks_list).union(affected))
+    else:
+        affected = None
+        rows, sig = read_source_csv(DF_PATH)
+        snapshot = build_world_rows(rows)
+        weeks = sorted(snapshot["year_week"].unique())
+
+    # Si los cortes de la leyenda cambian, todas las semanas cacheadas quedan viejas
+    classes_changed = set_world_classes(snapshot)
+    gdf, weeks_list = snapshot, weeks
+    mark_source_loaded("world", DF_PATH, *sig)
+    invalidate_responses("world", None if classes_changed else affected)
+    return {"modo": change, "semanas": affected if affected is not None else "todas"}
+
+def refresh_bangkok():
+    global bkk_engine
+    if bkk_engine is None:
+        return None
+    change = detect_source_change("bangkok")
+    change_bma = detect_source_change("bangkok_bma")
+    if change in (None, "sin cambios") and change_bma in (None, "sin cambios"):
+        return None
+
+    # Solo el CSV admite lectura parcial; si cambió el .xls del BMA se rearma todo
+    if change == "append" and change_bma in (None, "sin cambios"):
+        rows, sig = read_appended_csv("bangkok")
+        snapshot = bkk_with_rows(bkk_engine, rows)
+        sigs = {("bangkok", THAI_DATA_PATH): sig}
+        affected = sorted(rows["year_week"].dropna().unique())
+    else:
+        change, affected = "reload", None
+        rows, sigs = read_bkk_cases()
+        snapshot = build_bkk_engine(gdf_thai_geo, rows)
+
+    # Los payloads viven dentro del motor: publicar el snapshot ya invalida lo viejo
+    bkk_engine = snapshot
+    mark_sources_loaded(sigs)
+    return {"modo": change, "semanas": affected if affected is not None else "todas"}
+
+def refresh_argentina():
+    global gdf_arg_cache, arg_grouped_cache
+    change = detect_source_change("argentina")
+    if change in (None, "sin cambios") or arg_geo_cache is None:
+        return None
+
+    if change == "append":
+        rows, sig = read_appended_csv("argentina")
+        new_grouped = prepare_arg_cases(rows)
+        affected = sorted(new_grouped["year_week"].unique())
+        # Las filas nuevas suman a lo existente (mismo criterio que el groupby original)
+        grouped = (
+            pd.concat([arg_grouped_cache, new_grouped], ignore_index=True)
+            .groupby(["key_join", "ANIO", "SEPI", "year_week"], as_index=False)["CONFIRMADO"].sum()
+        )
+        fresh = merge_arg(arg_geo_cache, grouped[grouped["year_week"].isin(affected)])
+        snapshot = pd.concat(
+            [gdf_arg_cache[~gdf_arg_cache["year_week"].isin(affected)], fresh], ignore_index=True
+        )
+    else:
+        affected = None
+        rows, sig = read_source_csv(CASOS_ARG_PATH, sep=None, engine='python')
+        grouped = prepare_arg_cases(rows)
+        snapshot = merge_arg(arg_geo_cache, grouped)
+
+    classes_changed = set_region_classes("argentina", {"cases": grouped["CONFIRMADO"]})
+    arg_grouped_cache, gdf_arg_cache = grouped, snapshot
+    mark_source_loaded("argentina", CASOS_ARG_PATH, *sig)
+    invalidate_responses("argentina", None if classes_changed else affected)
+    return {"modo": change, "semanas": affected if affected is not None else "todas"}
+
+def refresh_brasil():
+    global df_brasil_cache
+    change = detect_source_change("brasil")
+    if change in (None, "sin cambios") or df_brasil_cache is None:
+        return None
+
+    if change == "append":
+        rows, sig = read_appended_csv("brasil")
+        _, new_grouped = prepare_brasil_cases(rows)
+        affected = sorted(new_grouped["year_week"].unique())
+        snapshot = (
+            pd.concat([df_brasil_cache, new_grouped], ignore_index=True)
+            .groupby(['year_week', 'ID_MN_RESI'])['casos'].sum().reset_index()
+        )
+        # El acumulado total también cambia
+        invalid = affected + ["total"]
+    else:
+        affected, invalid = None, None
+        rows, sig = read_source_csv(CSV_BRA_PATH, sep=None, engine='python')
+        _, snapshot = prepare_brasil_cases(rows)
+
+    classes_changed = set_region_classes("brasil", {"cases": snapshot["casos"]})
+    df_brasil_cache = snapshot
+    mark_source_loaded("brasil", CSV_BRA_PATH, *sig)
+    invalidate_responses("brasil", None if classes_changed else invalid)
+    return {"modo": change, "semanas": affected if affected is not None else "todas"}
+
+def refresh_thailand():
+    global thai_engine, thai_map_cache, model_cache
+    # Excel: no se puede leer "solo lo agregado", cualquier cambio recarga el archivo
+    change = detect_source_change("thailand")
+    if change in (None, "sin cambios") or thai_engine is None:
+        return None
+
+    engine = build_thai_engine()
+    geo = thai_map_cache
+    if geo is not None:
+        # Los códigos se vuelven a resolver por si el Excel trae provincias nuevas
+        geo = {**geo, **match_thai_map(geo["names"], engine)}
+    thai_engine, thai_map_cache = engine, geo
+    mark_source_loaded("thailand", THAI_CASES_PATH, *engine["source_sig"])
+    model_cache = None  # Se reentrena en el próximo request con los datos nuevos
+    return {"modo": "reload", "semanas": "todas"}
+
+REFRESHERS = {
+    "world": refresh_world,
+    "bangkok": refresh_bangkok,
+    "argentina": refresh_argentina,
+    "brasil": refresh_brasil,
+    "thailand": refresh_thailand,
+}
+
+def refresh_all():
+    """Revisa todas las fuentes y aplica los cambios. Devuelve solo las que cambiaron."""
+    cambios = {}
+    with refresh_lock:
+        for name, refresher in REFRESHERS.items():
+            try:
+                result = refresher()
+                if result is not None:
+                    cambios[name] = result
+                    invalidate_alerts(name)  # Las líneas base dependen de toda la serie
+            except Exception as e:
+                print(f">>> [Refresco] Error en {name}: {e}")
+                import traceback
+                traceback.print_exc()
+                cambios[name] = {"error": str(e)}
+    return cambios
+
+def watch_data_dir():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        cambios = refresh_all()
+        if cambios:
+            print(f">>> [Refresco] {cambios}")
+
+def start_data_watcher():
+    if REFRESH_INTERVAL > 0:
+        threading.Thread(target=watch_data_dir, name="data-watcher", daemon=True).start()
+        print(f">>> [Refresco] Vigilando {DATA_DIR} cada {REFRESH_INTERVAL}s")
+
+@app.post("/api/admin/refresh")
+def admin_refresh(x_admin_token: str = Header(None)):
+    """Fuerza un refresco inmediato. Requiere la variable de entorno ADMIN_TOKEN."""
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token or not secrets.compare_digest((x_admin_token or "").encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="Token de administrador inválido")
+    return refresh_all()
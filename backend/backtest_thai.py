@@ -0,0 +1,214 @@
+"""
+Backtesting con origen rodante (rolling origin) para el modelo de Tailandia.
+
+Evalúa varios modelos / hiperparámetros sobre muchos orígenes de pronóstico
+en paralelo (un proceso por núcleo) y promueve el mejor a data/thai_model.pkl,
+que es el artefacto que sirve /api/thailand/model/*.
+
+Uso (desde backend/):
+    python backtest_thai.py                       # grilla completa, promueve el mejor
+    python backtest_thai.py --start 2018-01-01 --step 6 --workers 4
+    python backtest_thai.py --no-promote          # solo reporte
+"""
+import os
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from thai_model import TARGET, THAI_MODEL_PATH, build_thai_features, thai_rmse_metrics
+
+# ==========================================
+# 1. CANDIDATOS (modelo + grilla de hiperparámetros)
+# ==========================================
+# Cada worker ya es un proceso: los modelos corren con 1 hilo para no sobresuscribir núcleos.
+CANDIDATE_GRIDS = {
+    "hgb": {"max_depth": [3, 6, 10], "learning_rate": [0.05, 0.1], "max_iter": [200]},
+    "lightgbm": {"num_leaves": [15, 31], "learning_rate": [0.05], "n_estimators": [300]},
+    "xgboost": {"max_depth": [3, 6], "learning_rate": [0.05], "n_estimators": [300]},
+    "catboost": {"depth": [4, 6], "learning_rate": [0.05], "iterations": [300]},
+}
+
+def make_model(name, params):
+    """Instancia un regresor. Las librerías opcionales se importan recién aquí."""
+    if name == "hgb":
+        return HistGradientBoostingRegressor(random_state=42, **params)
+    if name == "lightgbm":
+        from lightgbm import LGBMRegressor
+        return LGBMRegressor(random_state=42, n_jobs=1, verbose=-1, **params)
+    if name == "xgboost":
+        from xgboost import XGBRegressor
+        return XGBRegressor(random_state=42, n_jobs=1, **params)
+    if name == "catboost":
+        from catboost import CatBoostRegressor
+        return CatBoostRegressor(random_seed=42, thread_count=1, verbose=False, **params)
+    raise ValueError(f"Modelo desconocido: {name}")
+
+def available_candidates(names=None):
+    """Expande las grillas, saltando librerías que no estén instaladas."""
+    candidates = []
+    for name, grid in CANDIDATE_GRIDS.items():
+        if names and name not in names:
+            continue
+        try:
+            make_model(name, {})
+        except ImportError:
+            print(f"   ⚠️ {name} no está instalado, se omite.")
+            continue
+        keys = sorted(grid)
+        for values in itertools.product(*(grid[k] for k in keys)):
+            candidates.append((name, dict(zip(keys, values))))
+    return candidates
+
+# ==========================================
+# 2. WORKERS (matriz de features compartida, se envía una sola vez)
+# ==========================================
+_X = _y = _w = _dates = None
+
+def _init_worker(X, y, w, dates):
+    global _X, _y, _w, _dates
+    _X, _y, _w, _dates = X, y, w, dates
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+def _run_fold(task):
+    """Entrena con fechas < origen y predice la ventana [origen, fin). Devuelve (cand, y, pred)."""
+    cand_id, name, params, origin, end = task
+    train = _dates < origin
+    test = (_dates >= origin) & (_dates < end)
+    if not train.any() or not test.any():
+        return cand_id, np.empty(0), np.empty(0)
+    model = make_model(name, params)
+    model.fit(_X[train], _y[train], sample_weight=_w[train])
+    return cand_id, _y[test], model.predict(_X[test])
+
+# ==========================================
+# 3. BACKTEST
+# ==========================================
+def rolling_origins(dates, start, stop, step_months):
+    """
+    Orígenes mensuales cada step_months entre start y stop; la ventana de test va hasta el siguiente.
+    Se descartan los orígenes posteriores al último dato (no tendrían filas de test).
+    """
+    origins = pd.date_range(start, stop, freq=f"{step_months}MS")
+    origins = origins[origins <= pd.Timestamp(dates.max())]
+    if origins.empty:
+        return []
+    last = pd.Timestamp(dates.max()) + pd.offsets.MonthBegin(1)
+    ends = list(origins[1:]) + [min(origins[-1] + pd.DateOffset(months=step_months), last)]
+    return [(np.datetime64(o), np.datetime64(e)) for o, e in zip(origins, ends)]
+
+def run_backtest(df_model, features, candidates, origins, workers):
+    """Corre todas las combinaciones candidato x origen en un pool de procesos."""
+    X = df_model[features].to_numpy(dtype=float)
+    y = df_model[TARGET].to_numpy(dtype=float)
+    w = 1 + np.abs(y) * 5   # Mismo peso que el modelo servido
+    dates = df_model["date"].to_numpy(dtype="datetime64[ns]")
+
+    tasks = [
+        (cand_id, name, params, origin, end)
+        for cand_id, (name, params) in enumerate(candidates)
+        for origin, end in origins
+    ]
+    print(f">>> [Backtest] {len(candidates)} candidatos x {len(origins)} orígenes = {len(tasks)} fits en {workers} procesos")
+
+    y_all = {i: [] for i in range(len(candidates))}
+    p_all = {i: [] for i in range(len(candidates))}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, y, w, dates)) as pool:
+        for cand_id, y_true, pred in pool.map(_run_fold, tasks, chunksize=max(1, len(tasks) // (workers * 4))):
+            y_all[cand_id].append(y_true)
+            p_all[cand_id].append(pred)
+
+    rows = []
+    for cand_id, (name, params) in enumerate(candidates):
+        y_true, pred = np.concatenate(y_all[cand_id]), np.concatenate(p_all[cand_id])
+        if len(y_true) == 0:
+            print(f"   ⚠️ {name} {params}: ningún origen tuvo datos de test, se omite.")
+            continue
+        metrics = thai_rmse_metrics(y_true, pred)
+        rows.append({
+            "name": name,
+            "params": params,
+            "rmse_global": metrics["global"]["rmse_model"],
+            "rmse_outbreak": metrics["outbreak"]["rmse_model"],
+            "improvement": metrics["outbreak"]["improvement"],
+            "metrics": metrics,
+        })
+    return pd.DataFrame(rows)
+
+def promote(best, df_model, features, origins):
+    """Reentrena el mejor candidato con datos < 2024 (mismo corte que la API) y lo guarda."""
+    train = df_model[df_model["date"].dt.year < 2024]
+    model = make_model(best["name"], best["params"])
+    model.fit(train[features], train[TARGET], sample_weight=1 + train[TARGET].abs() * 5)
+
+    artifact = {
+        "name": best["name"],
+        "params": best["params"],
+        "features": features,
+        "model": model,
+        "backtest": {
+            "metrics": best["metrics"],
+            "origins": [str(o)[:10] for o, _ in origins],
+        },
+    }
+    pd.to_pickle(artifact, THAI_MODEL_PATH)
+    print(f">>> [Backtest] Modelo promovido a {THAI_MODEL_PATH}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtesting rolling-origin del modelo de Tailandia")
+    parser.add_argument("--start", default="2016-01-01", help="Primer origen de pronóstico")
+    parser.add_argument("--stop", default="2023-12-01", help="Último origen de pronóstico")
+    parser.add_argument("--step", type=int, default=3, help="Meses entre orígenes (= tamaño de la ventana de test)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Procesos en paralelo")
+    parser.add_argument("--models", nargs="*", help="Subconjunto de modelos (hgb lightgbm xgboost catboost)")
+    parser.add_argument("--metric", choices=["rmse_outbreak", "rmse_global"], default="rmse_outbreak")
+    parser.add_argument("--no-promote", action="store_true", help="No escribir el artefacto")
+    args = parser.parse_args()
+    try:
+        start, stop = pd.Timestamp(args.start), pd.Timestamp(args.stop)
+    except ValueError as e:
+        parser.error(f"fecha inválida: {e}")
+    if stop < start:
+        parser.error(f"--stop ({args.stop}) no puede ser anterior a --start ({args.start})")
+    if args.step < 1:
+        parser.error("--step debe ser >= 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers debe ser >= 1")
+    if args.models and set(args.models) - set(CANDIDATE_GRIDS):
+        parser.error(f"modelos desconocidos: {sorted(set(args.models) - set(CANDIDATE_GRIDS))}")
+
+    # Import diferido (solo para leer los casos): los workers no necesitan cargar la API
+    from app import load_thailand_resources, thai_cases_long
+    import app
+
+    load_thailand_resources()
+    if app.thai_engine is None:
+        raise SystemExit("No se pudieron cargar los casos de Tailandia")
+
+    # Features una sola vez para todos los folds
+    df_model, features = build_thai_features(thai_cases_long(app.thai_engine))
+    origins = rolling_origins(df_model["date"], start, stop, args.step)
+    if not origins:
+        raise SystemExit(f"No hay orígenes con datos de test entre {args.start} y {args.stop} (último dato: {df_model['date'].max():%Y-%m-%d})")
+    candidates = available_candidates(args.models)
+    if not candidates:
+        raise SystemExit("Ninguno de los modelos pedidos está instalado")
+
+    results = run_backtest(df_model, features, candidates, origins, args.workers)
+    if results.empty:
+        raise SystemExit("Ningún candidato tuvo predicciones para evaluar")
+    results = results.sort_values([args.metric, "rmse_global"]).reset_index(drop=True)
+    print(results[["name", "params", "rmse_global", "rmse_outbreak", "improvement"]].to_string())
+
+    if not args.no_promote:
+        promote(results.iloc[0], df_model, features, origins)
+
+if __name__ == "__main__":
+    main()
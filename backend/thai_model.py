@@ -0,0 +1,66 @@
+"""
+Features y métricas del modelo de Tailandia.
+
+Módulo sin efectos secundarios (no carga datos ni levanta la API): lo importan
+tanto app.py como backtest_thai.py y sus workers.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_error
+
+THAI_MODEL_PATH = Path(__file__).resolve().parent / "data" / "thai_model.pkl"  # Artefacto promovido por backtest_thai.py
+TARGET = "y_change_t1"
+
+def build_thai_features(df):
+    """
+    Ingeniería de features del notebook sobre el formato largo (date_str, province_raw, cases).
+    Devuelve (df_model, features). El target es y_change_t1 (cambio de log casos a t+1).
+    """
+    df = df.copy()
+
+    # Asegurar orden
+    df['date'] = pd.to_datetime(df['date_str'])
+    df = df.sort_values(['province_raw', 'date'])
+
+    # Target y Features
+    df['log_cases'] = np.log1p(df['cases'])
+    df[TARGET] = df.groupby('province_raw')['log_cases'].shift(-1) - df['log_cases']
+
+    # Lags (Simplificado para producción)
+    for l in [1, 2, 3]:
+        df[f'change_t-{l}'] = df.groupby('province_raw')['log_cases'].shift(l) - df.groupby('province_raw')['log_cases'].shift(l+1)
+        # (Clima y vecinos del notebook todavía no están en thai_engine)
+
+    df['month'] = df['date'].dt.month
+    df_model = df.dropna().copy()
+
+    features = [c for c in df_model.columns if 'change_t-' in c or c == 'month']
+    # (Añade temp/rain/vecinos a 'features' si están en tu df global)
+    return df_model, features
+
+def thai_rmse_metrics(y_test, pred_model):
+    """Métricas globales y de brotes (top 20% de |cambio|) contra el baseline de cambio 0."""
+    y_test = np.asarray(y_test, dtype=float)
+    pred_model = np.asarray(pred_model, dtype=float)
+    pred_base = np.zeros_like(pred_model)
+
+    # Globales
+    rmse_g = np.sqrt(mean_squared_error(y_test, pred_model))
+    rmse_b = np.sqrt(mean_squared_error(y_test, pred_base))
+
+    # Brotes
+    umbral = np.quantile(np.abs(y_test), 0.8)
+    mask = np.abs(y_test) >= umbral
+    rmse_g_out = np.sqrt(mean_squared_error(y_test[mask], pred_model[mask]))
+    rmse_b_out = np.sqrt(mean_squared_error(y_test[mask], pred_base[mask]))
+
+    return {
+        "global": {"rmse_model": round(float(rmse_g), 4), "rmse_base": round(float(rmse_b), 4)},
+        "outbreak": {
+            "rmse_model": round(float(rmse_g_out), 4),
+            "rmse_base": round(float(rmse_b_out), 4),
+            "improvement": round(float(100 * (1 - rmse_g_out/rmse_b_out)), 1)
+        }
+    }